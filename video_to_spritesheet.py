@@ -10,15 +10,29 @@ Video to Sprite Sheet Converter
 """
 
 import argparse
+import collections
+import contextlib
+import io
 import json
 import math
+import multiprocessing
 import os
+import queue
 import shutil
 import subprocess
 import sys
-import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 
+try:
+    import numpy as np
+except ImportError:
+    print("錯誤: 請先安裝 numpy 套件")
+    print("執行: pip install numpy")
+    sys.exit(1)
+
 try:
     from PIL import Image
 except ImportError:
@@ -28,12 +42,52 @@ except ImportError:
 
 # rembg 是可選的依賴
 REMBG_AVAILABLE = False
+REMBG_MODELS = None
 try:
+    from rembg import new_session
     from rembg import remove as rembg_remove
     REMBG_AVAILABLE = True
+    # 可用的模型名稱 (較舊的 rembg 沒有此清單，此時不檢查 --rembg-model)
+    from rembg.sessions import sessions_names as REMBG_MODELS
 except ImportError:
     pass
 
+# 每像素通道數對應的 FFmpeg 像素格式 (來源帶有透明度時才使用 RGBA)
+PIX_FMTS = {3: "rgb24", 4: "rgba"}
+
+# 帶有透明通道的 FFmpeg 像素格式前綴 (例如 ProRes 4444 的 yuva444p10le、qtrle 的 argb)
+ALPHA_PIX_FMT_PREFIXES = ("yuva", "ayuv", "vuya", "rgba", "bgra", "argb", "abgr", "ya", "gbrap", "pal8")
+
+# FFmpeg 失敗時顯示的 stderr 行數
+FFMPEG_STDERR_TAIL = 50
+
+# 讀取執行緒最多預先緩衝的幀數
+FRAME_QUEUE_SIZE = 8
+
+# Sprite Sheet 預設的最大邊長 (多數 GPU 的貼圖尺寸上限)
+DEFAULT_MAX_SHEET_DIM = 8192
+
+# WebP 格式允許的最大邊長
+WEBP_MAX_DIM = 16383
+
+# 每批同時送進 rembg 的幀數
+REMBG_BATCH_SIZE = 8
+
+# --rembg-device 對應的 ONNX Runtime execution provider
+REMBG_PROVIDERS = {
+    "cpu": ["CPUExecutionProvider"],
+    "cuda": ["CUDAExecutionProvider", "CPUExecutionProvider"],
+    "coreml": ["CoreMLExecutionProvider", "CPUExecutionProvider"],
+    "tensorrt": ["TensorrtExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider"],
+}
+
+# 平行處理時，每個 worker 行程各自持有的 rembg session
+_worker_session = None
+
+# worker 載入模型時的輸出 (附在該行程第一個影片的輸出紀錄前) 與是否載入失敗
+_worker_init_log = ""
+_worker_init_failed = False
+
 
 def check_ffmpeg():
     """檢查 FFmpeg 是否已安裝"""
@@ -44,6 +98,88 @@ def check_ffmpeg():
         sys.exit(1)
 
 
+def check_hwaccel(hwaccel):
+    """檢查明確指定的硬體解碼裝置是否可用
+
+    FFmpeg 只有 -hwaccel auto 會在不可用時退回軟體解碼，明確指定的裝置無法建立時會直接失敗，
+    因此在處理任何影片前先建立一次裝置確認。
+    """
+    if hwaccel in (None, "none", "auto"):
+        return
+    
+    cmd = ["ffmpeg", "-v", "error", "-init_hw_device", hwaccel,
+           "-f", "lavfi", "-i", "nullsrc=s=16x16", "-frames:v", "1", "-f", "null", "-"]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"錯誤: 無法使用硬體解碼 --hwaccel {hwaccel}")
+        print(result.stderr.strip())
+        print("請改用 --hwaccel auto (不可用時自動退回軟體解碼) 或 --hwaccel none")
+        sys.exit(1)
+
+
+def check_rembg_provider(device="auto"):
+    """檢查指定的 ONNX Runtime provider 是否可用，回傳要傳給 new_session 的 providers
+
+    device 為 auto 時回傳 None，交由 rembg 自行選擇；實際使用的 provider 於建立 session 後顯示。
+    """
+    import onnxruntime as ort
+    
+    available = ort.get_available_providers()
+    print(f"ONNX Runtime 裝置: {ort.get_device()}")
+    print(f"可用的 providers: {', '.join(available)}")
+    
+    if device == "auto":
+        return None
+    
+    providers = REMBG_PROVIDERS[device]
+    if providers[0] not in available:
+        print(f"錯誤: 指定了 --rembg-device {device}，但 {providers[0]} 不可用")
+        print_provider_help(providers[0])
+        sys.exit(1)
+    
+    return providers
+
+
+def print_provider_help(provider):
+    """顯示無法使用指定 provider 時的排除方式"""
+    if provider in ("CUDAExecutionProvider", "TensorrtExecutionProvider"):
+        print("請確認已安裝 CUDA/cuDNN，並執行:")
+        print('  pip uninstall onnxruntime && pip install onnxruntime-gpu')
+    elif provider == "CoreMLExecutionProvider":
+        print("CoreML 僅支援 macOS，請確認使用的是官方 onnxruntime 套件")
+
+
+def parse_frame_rate(rate, default=30.0):
+    """解析 ffprobe 的 "num/den" 幀率字串，格式錯誤時回傳 default"""
+    num, _, den = str(rate).partition("/")
+    try:
+        if den:
+            return int(num) / int(den)
+        return float(num)
+    except (ValueError, ZeroDivisionError):
+        return default
+
+
+def get_rotation(video_stream):
+    """取得影片串流的旋轉角度 (display matrix 或舊式 rotate 標籤)"""
+    for side_data in video_stream.get("side_data_list", []):
+        if "rotation" in side_data:
+            try:
+                return int(float(side_data["rotation"]))
+            except (TypeError, ValueError):
+                return 0
+    
+    try:
+        return int(video_stream.get("tags", {}).get("rotate", 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def has_alpha(pix_fmt):
+    """判斷 FFmpeg 像素格式是否帶有透明通道"""
+    return bool(pix_fmt) and pix_fmt.startswith(ALPHA_PIX_FMT_PREFIXES)
+
+
 def get_video_info(video_path):
     """取得影片資訊"""
     cmd = [
@@ -70,11 +206,25 @@ def get_video_info(video_path):
             print("錯誤: 找不到影片串流")
             sys.exit(1)
         
+        # FFmpeg 解碼時會自動套用旋轉，旋轉 90/270 度時輸出的寬高會互換
+        width = int(video_stream.get("width", 0))
+        height = int(video_stream.get("height", 0))
+        if get_rotation(video_stream) % 180 != 0:
+            width, height = height, width
+        
+        # 影片串流本身的長度 (容器長度可能因音訊較長而超過畫面實際長度)，未知時為 0
+        try:
+            video_duration = float(video_stream.get("duration", 0))
+        except (TypeError, ValueError):
+            video_duration = 0
+        
         return {
-            "width": int(video_stream.get("width", 0)),
-            "height": int(video_stream.get("height", 0)),
+            "width": width,
+            "height": height,
             "duration": float(info.get("format", {}).get("duration", 0)),
-            "fps": eval(video_stream.get("r_frame_rate", "30/1"))
+            "video_duration": video_duration,
+            "alpha": has_alpha(video_stream.get("pix_fmt")),
+            "fps": parse_frame_rate(video_stream.get("r_frame_rate", "30/1"))
         }
     except subprocess.CalledProcessError as e:
         print(f"錯誤: 無法讀取影片資訊 - {e}")
@@ -84,15 +234,20 @@ def get_video_info(video_path):
         sys.exit(1)
 
 
-def extract_frames(video_path, output_dir, fps, start_time=None, end_time=None, max_frames=None):
-    """從影片中抽取幀"""
-    cmd = ["ffmpeg", "-y"]
+def build_input_args(video_path, start_time=None, end_time=None, hwaccel=None):
+    """產生 FFmpeg 的輸入、硬體解碼與時間範圍參數"""
+    args = []
+    
+    # 硬體解碼 (解碼後的幀會自動傳回系統記憶體，後續過濾器不需更動；
+    # 只有 auto 會在不可用時退回軟體解碼，明確指定的裝置已由 check_hwaccel 確認)
+    if hwaccel and hwaccel != "none":
+        args.extend(["-hwaccel", hwaccel])
     
     # 起始時間
     if start_time is not None:
-        cmd.extend(["-ss", str(start_time)])
+        args.extend(["-ss", str(start_time)])
     
-    cmd.extend(["-i", str(video_path)])
+    args.extend(["-i", str(video_path)])
     
     # 結束時間
     if end_time is not None:
@@ -100,47 +255,149 @@ def extract_frames(video_path, output_dir, fps, start_time=None, end_time=None,
             duration = end_time - start_time
         else:
             duration = end_time
-        cmd.extend(["-t", str(duration)])
+        args.extend(["-t", str(duration)])
+    
+    return args
+
+
+def drain_stderr(proc, max_lines=FFMPEG_STDERR_TAIL):
+    """在背景執行緒持續讀取子行程的 stderr，只保留最後 max_lines 行供錯誤回報
+
+    避免 stderr 管線塞滿使 FFmpeg 卡住，也不會把整段輸出留在記憶體中。
+    回傳 (執行緒, 保存最後幾行的 deque)。
+    """
+    tail = collections.deque(maxlen=max_lines)
+    
+    def _drain():
+        for line in proc.stderr:
+            tail.append(line)
+    
+    thread = threading.Thread(target=_drain, daemon=True)
+    thread.start()
+    return thread, tail
+
+
+def estimate_frame_count(duration, fps, start_time=None, end_time=None):
+    """由 ffprobe 取得的影片串流長度估計抽取的幀數，長度未知時回傳 None"""
+    if not duration:
+        return None
+    
+    start = start_time or 0
+    end = min(end_time, duration) if end_time is not None else duration
+    return max(end - start, 0) * fps
+
+
+def get_frame_count(video_path, fps, start_time=None, end_time=None, max_frames=None, hwaccel=None, duration=None):
+    """取得以指定 fps 抽取時會得到的幀數
+
+    duration 為 ffprobe 取得的影片串流長度 (非容器長度)。由長度可確定幀數必定達到 max_frames 時
+    (保留一幀誤差) 直接回傳 max_frames，不需再完整解碼一次；長度未知時一律完整計算幀數。
+    """
+    expected = estimate_frame_count(duration, fps, start_time, end_time)
+    if max_frames is not None and expected is not None and expected - 1 >= max_frames:
+        return max_frames
+    return count_frames(video_path, fps, start_time, end_time, max_frames, hwaccel)
+
+
+def count_frames(video_path, fps, start_time=None, end_time=None, max_frames=None, hwaccel=None):
+    """計算以指定 fps 抽取時會得到的幀數 (只解碼，不縮放也不輸出影像)"""
+    cmd = ["ffmpeg", "-v", "error", "-nostats"]
+    cmd.extend(build_input_args(video_path, start_time, end_time, hwaccel))
+    cmd.extend(["-an", "-sn", "-vf", f"fps={fps}"])
+    
+    if max_frames is not None:
+        cmd.extend(["-frames:v", str(max_frames)])
+    
+    cmd.extend(["-progress", "pipe:1", "-f", "null", "-"])
+    
+    print(f"正在計算幀數... (fps={fps})")
+    
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_thread, stderr_tail = drain_stderr(proc)
+    
+    # -progress 會持續輸出多組 key=value，邊讀邊保留最後一個 frame 值
+    count = 0
+    for line in proc.stdout:
+        key, _, value = line.partition(b"=")
+        if key == b"frame":
+            count = int(value)
     
-    # 幀率過濾器
-    vf_filters = [f"fps={fps}"]
+    proc.stdout.close()
+    stderr_thread.join()
+    if proc.wait() != 0:
+        print(f"錯誤: FFmpeg 執行失敗")
+        print(b"".join(stderr_tail).decode(errors="replace"))
+        sys.exit(1)
+    
+    return count
+
+
+def extract_frames(video_path, width, height, fps, start_time=None, end_time=None, max_frames=None, hwaccel=None):
+    """從影片中抽取幀
+
+    以 RGB rawvideo 經由 stdout 串流輸出，
+    逐幀 yield 形狀為 (height, width, 3) 的 numpy 陣列，不再將每幀寫成 PNG 暫存檔再讀回。
+    讀取由背景執行緒透過有上限的佇列進行，FFmpeg 解碼與呼叫端的處理可以同時進行。
+    """
+    cmd = ["ffmpeg", "-v", "error"]
+    cmd.extend(build_input_args(video_path, start_time, end_time, hwaccel))
+    
+    # 幀率與縮放過濾器 (縮放由 FFmpeg 完成，同時確保每幀位元組數一致)
+    vf_filters = [f"fps={fps}", f"scale={width}:{height}:flags=lanczos"]
     cmd.extend(["-vf", ",".join(vf_filters)])
     
     # 最大幀數
     if max_frames is not None:
         cmd.extend(["-frames:v", str(max_frames)])
     
-    # 輸出格式
-    output_pattern = os.path.join(output_dir, "frame_%05d.png")
-    cmd.append(output_pattern)
+    # 輸出格式：原始像素經由 stdout 傳回
+    frame_bytes = width * height * 3
+    cmd.extend(["-f", "rawvideo", "-pix_fmt", PIX_FMTS[3], "pipe:1"])
     
     print(f"正在抽取幀... (fps={fps})")
     
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=frame_bytes * 4)
+    stderr_thread, stderr_tail = drain_stderr(proc)
+    frame_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+    
+    def _reader():
+        while True:
+            buf = proc.stdout.read(frame_bytes)
+            if len(buf) < frame_bytes:
+                break
+            frame_queue.put(np.frombuffer(buf, dtype=np.uint8).reshape(height, width, 3))
+        frame_queue.put(None)
+    
+    reader = threading.Thread(target=_reader, daemon=True)
+    reader.start()
+    
+    finished = False
     try:
-        subprocess.run(cmd, capture_output=True, check=True)
-    except subprocess.CalledProcessError as e:
+        while True:
+            frame = frame_queue.get()
+            if frame is None:
+                finished = True
+                break
+            yield frame
+    finally:
+        if not finished:
+            # 呼叫端提前結束：停止 FFmpeg，並清空佇列讓讀取執行緒結束
+            proc.kill()
+            while frame_queue.get() is not None:
+                pass
+        reader.join()
+        proc.stdout.close()
+        stderr_thread.join()
+        returncode = proc.wait()
+    
+    if returncode != 0:
         print(f"錯誤: FFmpeg 執行失敗")
-        print(e.stderr.decode() if e.stderr else "")
+        print(b"".join(stderr_tail).decode(errors="replace"))
         sys.exit(1)
-    
-    # 取得所有抽取的幀
-    frames = sorted(Path(output_dir).glob("frame_*.png"))
-    print(f"已抽取 {len(frames)} 幀")
-    
-    return frames
 
 
-def create_spritesheet(frames, output_path, frame_width=None, frame_height=None, columns=None, remove_bg=False):
-    """將幀合成為 Sprite Sheet"""
-    if not frames:
-        print("錯誤: 沒有可用的幀")
-        sys.exit(1)
-    
-    # 載入第一幀來取得尺寸
-    first_frame = Image.open(frames[0])
-    original_width, original_height = first_frame.size
-    
-    # 計算每幀的尺寸
+def compute_frame_size(original_width, original_height, frame_width=None, frame_height=None):
+    """計算每幀縮放後的尺寸"""
     if frame_width and frame_height:
         target_width = frame_width
         target_height = frame_height
@@ -156,8 +413,11 @@ def create_spritesheet(frames, output_path, frame_width=None, frame_height=None,
         target_width = original_width
         target_height = original_height
     
-    # 計算行列數
-    num_frames = len(frames)
+    return target_width, target_height
+
+
+def compute_grid(num_frames, columns=None):
+    """計算 Sprite Sheet 的行列數"""
     if columns:
         cols = columns
         rows = math.ceil(num_frames / cols)
@@ -169,87 +429,480 @@ def create_spritesheet(frames, output_path, frame_width=None, frame_height=None,
         cols = n
         rows = n
     
-    # 若幀數不足以填滿偶數格子，用最後一幀填滿
-    total_slots = cols * rows
-    if num_frames < total_slots and frames:
-        padding_count = total_slots - num_frames
-        frames = list(frames) + [frames[-1]] * padding_count
-        print(f"幀數 {num_frames} 不足 {cols}x{rows}={total_slots} 格，以最後一幀填補 {padding_count} 格")
+    return cols, rows
+
+
+def fit_grid(num_frames, cols, rows, frame_width, frame_height, max_dim=None):
+    """將網格限制在 max_dim 以內，超過時拆成多頁
+
+    回傳每頁的 (cols, rows)、頁數與最後一頁的行數；單幀就超過 max_dim 時回傳 None。
+    多頁時最後一頁只保留放得下剩餘幀數的行數，只有最後一行會以最後一幀填補。
+    """
+    if not max_dim or (cols * frame_width <= max_dim and rows * frame_height <= max_dim):
+        return cols, rows, 1, rows
     
-    # 建立 Sprite Sheet
-    sheet_width = cols * target_width
-    sheet_height = rows * target_height
+    max_cols = max_dim // frame_width
+    max_rows = max_dim // frame_height
+    if max_cols == 0 or max_rows == 0:
+        print(f"錯誤: 每幀尺寸 {frame_width} x {frame_height} 超過 Sprite Sheet 上限 {max_dim}")
+        return None
+    
+    cols = min(cols, max_cols)
+    rows = min(math.ceil(num_frames / cols), max_rows)
+    pages = math.ceil(num_frames / (cols * rows))
+    last_rows = math.ceil((num_frames - cols * rows * (pages - 1)) / cols)
+    return cols, rows, pages, last_rows
+
+
+def page_paths(output_path, pages):
+    """產生每頁的輸出路徑，多頁時在檔名後加上頁碼 (例如 foo_0.png、foo_1.png)"""
+    if pages == 1:
+        return [str(output_path)]
+    path = Path(output_path)
+    return [str(path.with_name(f"{path.stem}_{i}{path.suffix}")) for i in range(pages)]
+
+
+def print_layout(num_frames, cols, rows, frame_width, frame_height, pages=1, last_rows=None):
+    """顯示排列資訊"""
+    last_rows = rows if last_rows is None else last_rows
+    total_slots = cols * rows * (pages - 1) + cols * last_rows
+    if num_frames < total_slots:
+        padding_count = total_slots - num_frames
+        slots = f"{cols}x{rows}={total_slots}" if pages == 1 else f"{pages} 頁共 {total_slots}"
+        print(f"幀數 {num_frames} 不足 {slots} 格，以最後一幀填補 {padding_count} 格")
     
-    print(f"Sprite Sheet 尺寸: {sheet_width} x {sheet_height}")
+    print(f"Sprite Sheet 尺寸: {cols * frame_width} x {rows * frame_height}")
     print(f"排列: {cols} 列 x {rows} 行")
-    print(f"每幀尺寸: {target_width} x {target_height}")
-    if remove_bg:
-        print("背景移除: 啟用")
+    if pages > 1:
+        print(f"超過尺寸上限，分為 {pages} 頁")
+        if last_rows != rows:
+            print(f"最後一頁: {cols * frame_width} x {last_rows * frame_height} ({last_rows} 行)")
+    print(f"每幀尺寸: {frame_width} x {frame_height}")
+
+
+def iter_grid_frames(cols, rows, frame_width, frame_height, pages=1, last_rows=None):
+    """依網格排列逐一產生每個格子的位置資訊，多頁時另外記錄所在頁碼 (最後一頁為 last_rows 行)"""
+    per_page = cols * rows
+    last_rows = rows if last_rows is None else last_rows
+    for i in range(per_page * (pages - 1) + cols * last_rows):
+        slot = i % per_page
+        frame = {
+            "index": i,
+            "x": (slot % cols) * frame_width,
+            "y": (slot // cols) * frame_height,
+            "w": frame_width,
+            "h": frame_height
+        }
+        if pages > 1:
+            frame["page"] = i // per_page
+        yield frame
+
+
+def build_page_list(paths, sizes):
+    """產生 metadata 中的分頁清單"""
+    return [{"file": Path(path).name, "w": w, "h": h} for path, (w, h) in zip(paths, sizes)]
+
+
+def build_metadata(num_frames, cols, rows, frame_width, frame_height, channels=4, paths=None, last_rows=None):
+    """產生網格排列的 metadata
+
+    網格中每幀的位置可由 meta 推得 (x = (i % columns) * w, y = (i // columns) * h)，
+    因此不預先建立 frames 清單，由 save_metadata 寫檔時逐筆產生。
+    多頁時 meta.pages 列出每頁的檔名與尺寸 (最後一頁為 last_rows 行)，每幀另有 page 欄位。
+    """
+    metadata = {
+        "meta": {
+            "size": {"w": cols * frame_width, "h": rows * frame_height},
+            "frameSize": {"w": frame_width, "h": frame_height},
+            "columns": cols,
+            "rows": rows,
+            "totalFrames": num_frames,
+            "format": "RGBA8888" if channels == 4 else "RGB888"
+        }
+    }
+    
+    if paths and len(paths) > 1:
+        last_rows = rows if last_rows is None else last_rows
+        sizes = [(cols * frame_width, rows * frame_height)] * (len(paths) - 1)
+        sizes.append((cols * frame_width, last_rows * frame_height))
+        metadata["meta"]["pages"] = build_page_list(paths, sizes)
+    
+    return metadata
+
+
+def save_spritesheet(sheet, output_path, image_format="png", compress_level=1):
+    """將 sheet 陣列編碼並儲存
+
+    compress_level 為 0-9，數字越大檔案越小但編碼越慢；WebP 一律為無損壓縮。
+    """
+    image = Image.fromarray(sheet, "RGBA" if sheet.shape[2] == 4 else "RGB")
+    if image_format == "webp":
+        image.save(output_path, "WEBP", lossless=True,
+                   quality=round(compress_level / 9 * 100), method=round(compress_level / 9 * 6))
+    else:
+        image.save(output_path, "PNG", compress_level=compress_level)
+    print(f"已儲存: {output_path}")
+
+
+def create_spritesheet_ffmpeg(video_path, output_path, width, height, fps, start_time=None, end_time=None,
+                              max_frames=None, columns=None, image_format="png", compress_level=1,
+                              max_dim=DEFAULT_MAX_SHEET_DIM, hwaccel=None, duration=None, alpha=False):
+    """以 FFmpeg 的 tile 過濾器一次完成抽幀、縮放與合成
+
+    不需要逐幀回到 Python，只適用於不移除背景的情況。超過 max_dim 時 tile 會依序輸出多頁。
+    duration 為 ffprobe 取得的影片串流長度，用來判斷能否省略計算幀數的解碼 (見 get_frame_count)。
+    alpha 為 True 時 (來源帶有透明通道) 以 RGBA 輸出以保留透明度。失敗時回傳 None。
+    """
+    num_frames = get_frame_count(video_path, fps, start_time, end_time, max_frames, hwaccel, duration)
+    if num_frames == 0:
+        print("錯誤: 未能抽取任何幀")
+        return None
+    
+    print(f"共 {num_frames} 幀")
+    print()
+    
+    cols, rows = compute_grid(num_frames, columns)
+    layout = fit_grid(num_frames, cols, rows, width, height, max_dim)
+    if layout is None:
+        return None
+    cols, rows, pages, last_rows = layout
+    print_layout(num_frames, cols, rows, width, height, pages, last_rows)
     
-    spritesheet = Image.new("RGBA", (sheet_width, sheet_height), (0, 0, 0, 0))
+    # trim 截取前 num_frames 幀，tpad 以最後一幀無限延伸來填滿剩餘格子
+    # (tile 每頁固定輸出 cols x rows，最後一頁多出的行在儲存前裁掉)
+    vf_filters = [
+        f"fps={fps}",
+        f"scale={width}:{height}:flags=lanczos",
+        f"trim=end_frame={num_frames}",
+        "tpad=stop_mode=clone:stop=-1",
+        f"tile={cols}x{rows}",
+    ]
+    
+    cmd = ["ffmpeg", "-v", "error", "-y"]
+    cmd.extend(build_input_args(video_path, start_time, end_time, hwaccel))
+    cmd.extend(["-an", "-sn", "-vf", ",".join(vf_filters)])
+    # 每頁合成好的 sheet 依序以 rawvideo 傳回，統一由 save_spritesheet 編碼
+    # 來源沒有透明通道時全程使用 RGB，省下 1/4 的資料量
+    channels = 4 if alpha else 3
+    cmd.extend(["-frames:v", str(pages), "-f", "rawvideo", "-pix_fmt", PIX_FMTS[channels], "pipe:1"])
+    
+    print("正在合成 Sprite Sheet...")
+    
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_thread, stderr_tail = drain_stderr(proc)
+    
+    paths = page_paths(output_path, pages)
+    page_bytes = rows * height * cols * width * channels
+    saved = 0
+    for page, path in enumerate(paths):
+        buf = proc.stdout.read(page_bytes)
+        if len(buf) < page_bytes:
+            break
+        sheet = np.frombuffer(buf, dtype=np.uint8).reshape(rows * height, cols * width, channels)
+        if page == pages - 1:
+            sheet = sheet[:last_rows * height]
+        save_spritesheet(sheet, path, image_format, compress_level)
+        saved += 1
+    
+    proc.stdout.close()
+    stderr_thread.join()
+    if proc.wait() != 0 or saved < pages:
+        print(f"錯誤: FFmpeg 執行失敗")
+        print(b"".join(stderr_tail).decode(errors="replace"))
+        return None
+    
+    return build_metadata(num_frames, cols, rows, width, height, channels=channels, paths=paths, last_rows=last_rows)
+
+
+def create_rembg_session(model_name=None, providers=None, num_threads=None):
+    """建立 rembg session (載入模型)，未指定模型時使用 rembg 的預設模型
+
+    providers 為 --rembg-device 指定的 providers；實際使用的 provider 不符 (例如缺少 CUDA/cuDNN 函式庫
+    而退回 CPU) 時直接結束，不會默默以 CPU 執行。
+    num_threads 為 ONNX Runtime 推論可用的執行緒數，平行處理多個影片時用來分配 CPU 核心。
+    """
+    print(f"正在載入去背模型: {model_name or '預設'}")
+    
+    kwargs = {}
+    if providers is not None:
+        kwargs["providers"] = providers
+    if num_threads is not None:
+        import onnxruntime as ort
+        
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = num_threads
+        kwargs["sess_opts"] = sess_opts
+    
+    if model_name:
+        session = new_session(model_name, **kwargs)
+    else:
+        session = new_session(**kwargs)
+    
+    # 顯示實際使用的 provider (rembg 自動選擇時只會挑 CUDA/ROCm/OpenVINO，其他情況會退回 CPU)
+    provider = session.inner_session.get_providers()[0]
+    print(f"背景移除使用: {provider}")
+    if providers is not None and provider != providers[0]:
+        print(f"錯誤: 指定的 {providers[0]} 無法啟用，ONNX Runtime 退回了 {provider}")
+        print_provider_help(providers[0])
+        sys.exit(1)
+    if provider == "CPUExecutionProvider":
+        print("警告: 背景移除將以 CPU 執行，速度較慢")
+        print("若有可用的 GPU，請以 --rembg-device 指定，或執行: pip uninstall onnxruntime && pip install onnxruntime-gpu")
+    
+    return session
+
+
+def remove_background(frames, session, batch_size=REMBG_BATCH_SIZE, total=None):
+    """批次移除背景，逐幀 yield 去背後的 RGBA 幀
+
+    共用同一個 rembg session，每批 batch_size 幀以執行緒平行推論
+    (ONNX Runtime 推論期間會釋放 GIL)。frames 可為串流中的 iterator，邊抽幀邊去背，
+    不會在記憶體中保留所有幀。total 為預期的幀數，僅用於顯示進度。
+    """
+    done = 0
+    frames = iter(frames)
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        while True:
+            batch = list(islice(frames, batch_size))
+            if not batch:
+                break
+            for result in executor.map(lambda frame: rembg_remove(frame, session=session), batch):
+                yield result
+            
+            # 顯示進度
+            done += len(batch)
+            progress = f"{done}/{total}" if total else f"{done}"
+            print(f"\r去背進度: {progress} 幀", end="", flush=True)
+    
+    print()  # 換行
+
+
+def crop_to_content(frame):
+    """將 RGBA 幀裁切到不透明區域，回傳 (裁切後的幀, 左上角 x, 左上角 y)"""
+    alpha = frame[:, :, 3]
+    ys = np.flatnonzero(alpha.any(axis=1))
+    xs = np.flatnonzero(alpha.any(axis=0))
+    if ys.size == 0:
+        # 完全透明的幀保留 1x1 像素
+        return frame[:1, :1], 0, 0
+    return frame[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1], int(xs[0]), int(ys[0])
+
+
+def pack_shelf(sizes, max_dim=None):
+    """以 shelf 演算法排列不同尺寸的矩形
+
+    依高度由大到小逐一放入目前的行 (shelf)，放不下時換行，減少每行浪費的高度；
+    高度超過 max_dim 時換頁。呼叫端需確保每個矩形本身不超過 max_dim。
+    回傳 (sheet 寬, 每頁高度, 每個矩形的 (頁碼, x, y))，順序與 sizes 相同。
+    """
+    total_area = sum(w * h for w, h in sizes)
+    sheet_width = max(max(w for w, _ in sizes), math.ceil(math.sqrt(total_area)))
+    if max_dim:
+        sheet_width = min(sheet_width, max_dim)
+    
+    positions = [None] * len(sizes)
+    page_heights = []
+    page = x = y = shelf_height = 0
+    for i in sorted(range(len(sizes)), key=lambda i: sizes[i][1], reverse=True):
+        w, h = sizes[i]
+        if x + w > sheet_width:
+            y += shelf_height
+            x = 0
+            shelf_height = 0
+        if max_dim and y + h > max_dim:
+            page_heights.append(y)
+            page += 1
+            x = y = shelf_height = 0
+        positions[i] = (page, x, y)
+        x += w
+        shelf_height = max(shelf_height, h)
+    page_heights.append(y + shelf_height)
+    
+    return sheet_width, page_heights, positions
+
+
+def compose_grid(frames, num_frames, frame_size, output_path, columns=None, max_dim=None):
+    """將同尺寸的 RGBA 幀以網格排列合成
+
+    frames 為逐幀產生的 iterator，num_frames 為預先計算的幀數，用來先決定排列，
+    之後每讀滿一頁就產生該頁，記憶體中只保留目前這一頁與一行的幀。
+    回傳 (metadata, pages)，pages 為逐頁產生 (輸出路徑, sheet) 的 generator；
+    單幀就超過 max_dim 時回傳 None。
+    """
+    target_width, target_height = frame_size
+    channels = 4
+    
+    # 計算行列數
+    cols, rows = compute_grid(num_frames, columns)
+    layout = fit_grid(num_frames, cols, rows, target_width, target_height, max_dim)
+    if layout is None:
+        return None
+    cols, rows, pages, last_rows = layout
+    print_layout(num_frames, cols, rows, target_width, target_height, pages, last_rows)
+    
+    paths = page_paths(output_path, pages)
+    frames = iter(frames)
+    
+    def _pages():
+        last_frame = None
+        for page, path in enumerate(paths):
+            # 建立 Sprite Sheet (每個格子都會被寫入，不需預先清零；最後一頁只配置需要的行數)
+            page_rows = last_rows if page == pages - 1 else rows
+            sheet = np.empty((page_rows * target_height, cols * target_width, channels), dtype=np.uint8)
+            
+            # 逐行合成：一整行的幀橫向串接後，直接寫入 sheet 中連續的記憶體區塊
+            for row in range(page_rows):
+                row_frames = list(islice(frames, cols))
+                if row_frames:
+                    last_frame = row_frames[-1]
+                elif last_frame is None:
+                    print("錯誤: 未能抽取任何幀")
+                    return
+                
+                # 若幀數不足以填滿偶數格子，用最後一幀填滿
+                row_frames.extend([last_frame] * (cols - len(row_frames)))
+                band = sheet[row * target_height:(row + 1) * target_height]
+                np.concatenate(row_frames, axis=1, out=band)
+            
+            print()  # 結束去背進度的那一行
+            yield path, sheet
+    
+    metadata = build_metadata(num_frames, cols, rows, target_width, target_height, channels, paths, last_rows)
+    return metadata, _pages()
+
+
+def compose_shelf(frames, frame_size, output_path, max_dim=None):
+    """將去背後的幀裁掉透明邊緣，再以 shelf 演算法緊密排列
+
+    frames 為逐幀產生的 RGBA iterator，每幀讀入後立即裁切，只保留裁切後的區域。
+    回傳 (metadata, pages)，pages 為逐頁產生 (輸出路徑, sheet) 的 generator；
+    沒有任何幀或單幀就超過 max_dim 時回傳 None。
+    metadata 中每幀的 offsetX/offsetY 為裁切區域在原始幀中的位置。
+    """
+    target_width, target_height = frame_size
+    channels = 4
+    if max_dim and (target_width > max_dim or target_height > max_dim):
+        print(f"錯誤: 每幀尺寸 {target_width} x {target_height} 超過 Sprite Sheet 上限 {max_dim}")
+        return None
+    
+    cropped = [crop_to_content(frame) for frame in frames]
+    if not cropped:
+        print("錯誤: 未能抽取任何幀")
+        return None
+    
+    print(f"共 {len(cropped)} 幀")
+    print()
+    
+    sizes = [(crop.shape[1], crop.shape[0]) for crop, _, _ in cropped]
+    sheet_width, page_heights, positions = pack_shelf(sizes, max_dim)
+    pages = len(page_heights)
+    
+    print(f"Sprite Sheet 尺寸: {sheet_width} x {max(page_heights)}")
+    print("排列: shelf (依高度排序緊密排列)")
+    if pages > 1:
+        print(f"超過尺寸上限，分為 {pages} 頁")
+    print(f"原始幀尺寸: {target_width} x {target_height}")
+    
+    paths = page_paths(output_path, pages)
     
-    # 記錄 metadata
     metadata = {
         "frames": [],
         "meta": {
-            "size": {"w": sheet_width, "h": sheet_height},
+            "size": {"w": sheet_width, "h": max(page_heights)},
             "frameSize": {"w": target_width, "h": target_height},
-            "columns": cols,
-            "rows": rows,
-            "totalFrames": num_frames
+            "pack": "shelf",
+            "totalFrames": len(cropped),
+            "format": "RGBA8888"
         }
     }
+    if pages > 1:
+        metadata["meta"]["pages"] = build_page_list(paths, [(sheet_width, h) for h in page_heights])
     
-    # 合成每一幀
-    for i, frame_path in enumerate(frames):
-        col = i % cols
-        row = i // cols
-        x = col * target_width
-        y = row * target_height
-        
-        # 載入並縮放幀
-        frame = Image.open(frame_path)
-        if frame.size != (target_width, target_height):
-            frame = frame.resize((target_width, target_height), Image.Resampling.LANCZOS)
-        
-        # 確保是 RGBA 模式
-        if frame.mode != "RGBA":
-            frame = frame.convert("RGBA")
-        
-        # 移除背景
-        if remove_bg:
-            frame = rembg_remove(frame)
-        
-        # 貼上幀
-        spritesheet.paste(frame, (x, y))
-        
-        # 記錄 metadata
-        metadata["frames"].append({
+    for i, ((crop, offset_x, offset_y), (page, x, y)) in enumerate(zip(cropped, positions)):
+        h, w = crop.shape[:2]
+        frame = {
             "index": i,
             "x": x,
             "y": y,
-            "w": target_width,
-            "h": target_height
-        })
-        
-        # 顯示進度
-        progress = (i + 1) / len(frames) * 100
-        print(f"\r合成進度: {progress:.1f}%", end="", flush=True)
+            "w": w,
+            "h": h,
+            "offsetX": offset_x,
+            "offsetY": offset_y
+        }
+        if pages > 1:
+            frame["page"] = page
+        metadata["frames"].append(frame)
     
-    print()  # 換行
+    def _pages():
+        for page, path in enumerate(paths):
+            sheet = np.zeros((page_heights[page], sheet_width, channels), dtype=np.uint8)
+            for (crop, _, _), (crop_page, x, y) in zip(cropped, positions):
+                if crop_page == page:
+                    h, w = crop.shape[:2]
+                    sheet[y:y + h, x:x + w] = crop
+            yield path, sheet
     
-    # 儲存 Sprite Sheet
-    spritesheet.save(output_path, "PNG")
-    print(f"已儲存: {output_path}")
+    return metadata, _pages()
+
+
+def create_spritesheet(frames, output_path, frame_size, num_frames=None, columns=None, session=None,
+                       image_format="png", compress_level=1, pack="grid", max_dim=DEFAULT_MAX_SHEET_DIM):
+    """移除背景後將幀合成為 Sprite Sheet (不移除背景時由 create_spritesheet_ffmpeg 處理)
+
+    frames 為 extract_frames 產生、已縮放至 frame_size (寬, 高) 的 RGB numpy 陣列 iterator；
+    移除背景後的幀為 RGBA。網格排列需要預先計算的幀數 num_frames，邊去背邊合成並逐頁儲存。
+    session 為共用的 rembg session，未提供時才會另外建立。
+    pack 為 "shelf" 時會裁掉透明邊緣並緊密排列。
+    sheet 任一邊超過 max_dim 時會拆成多頁輸出。沒有任何幀或無法排列時回傳 None。
+    """
+    print("背景移除: 啟用")
+    if session is None:
+        session = create_rembg_session()
+    frames = remove_background(frames, session, total=num_frames)
+    
+    if pack == "shelf":
+        result = compose_shelf(frames, frame_size, output_path, max_dim)
+    else:
+        print(f"共 {num_frames} 幀")
+        print()
+        result = compose_grid(frames, num_frames, frame_size, output_path, columns, max_dim)
+    if result is None:
+        return None
+    
+    # 逐頁合成並儲存 Sprite Sheet
+    metadata, pages = result
+    saved = 0
+    for path, sheet in pages:
+        save_spritesheet(sheet, path, image_format, compress_level)
+        saved += 1
+    if saved == 0:
+        return None
     
     return metadata
 
 
 def save_metadata(metadata, output_path):
-    """儲存 metadata 為 JSON 檔案"""
+    """儲存 metadata 為 JSON 檔案
+
+    frames 逐筆寫入 (每幀一行)，網格排列時由 meta 即時產生，不需在記憶體中保留整份清單。
+    """
+    meta = metadata["meta"]
+    frames = metadata.get("frames")
+    if frames is None:
+        frame_w, frame_h = meta["frameSize"]["w"], meta["frameSize"]["h"]
+        pages = meta.get("pages", [])
+        last_rows = pages[-1]["h"] // frame_h if pages else meta["rows"]
+        frames = iter_grid_frames(meta["columns"], meta["rows"], frame_w, frame_h, len(pages) or 1, last_rows)
+    
     json_path = Path(output_path).with_suffix(".json")
     with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
+        f.write('{\n  "frames": [')
+        for i, frame in enumerate(frames):
+            f.write(",\n    " if i else "\n    ")
+            f.write(json.dumps(frame, ensure_ascii=False))
+        f.write('\n  ],\n  "meta": ')
+        f.write(json.dumps(meta, indent=2, ensure_ascii=False).replace("\n", "\n  "))
+        f.write("\n}\n")
     print(f"已儲存 metadata: {json_path}")
 
 
@@ -260,16 +913,17 @@ VIDEO_EXTENSIONS = {".mp4", ".avi", ".mov", ".mkv", ".webm", ".wmv", ".flv", ".m
 def find_video_files(directory):
     """在指定資料夾中搜尋所有影片檔案"""
     video_files = []
-    dir_path = Path(directory)
     
-    for file_path in dir_path.iterdir():
-        if file_path.is_file() and file_path.suffix.lower() in VIDEO_EXTENSIONS:
-            video_files.append(file_path)
+    # DirEntry.is_file() 使用掃描目錄時取得的快取資訊，不需逐一 stat
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS and entry.is_file():
+                video_files.append(Path(entry.path))
     
     return sorted(video_files)
 
 
-def process_single_video(input_path, output_path, args):
+def process_single_video(input_path, output_path, args, session=None):
     """處理單一影片檔案"""
     # 取得影片資訊
     print(f"輸入影片: {input_path}")
@@ -277,6 +931,8 @@ def process_single_video(input_path, output_path, args):
     print(f"影片尺寸: {video_info['width']} x {video_info['height']}")
     print(f"影片長度: {video_info['duration']:.2f} 秒")
     print(f"影片 FPS: {video_info['fps']:.2f}")
+    if video_info['alpha']:
+        print("影片含透明通道")
     print()
     
     # 計算縮放後的尺寸
@@ -291,41 +947,119 @@ def process_single_video(input_path, output_path, args):
         print(f"等比縮放: {args.percent}% ({frame_width} x {frame_height})")
         print()
     
-    # 建立暫存目錄
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # 抽取幀
-        frames = extract_frames(
+    target_width, target_height = compute_frame_size(
+        video_info['width'],
+        video_info['height'],
+        frame_width,
+        frame_height
+    )
+    
+    if not args.remove_bg:
+        # 不需移除背景時，整個流程交由 FFmpeg 完成
+        metadata = create_spritesheet_ffmpeg(
             input_path,
-            temp_dir,
+            output_path,
+            target_width,
+            target_height,
             fps=args.fps,
             start_time=args.start,
             end_time=args.end,
-            max_frames=args.max_frames
+            max_frames=args.max_frames,
+            hwaccel=args.hwaccel,
+            duration=video_info['video_duration'],
+            alpha=video_info['alpha'],
+            columns=args.columns,
+            image_format=args.format,
+            compress_level=args.compress_level,
+            max_dim=args.max_sheet_dim
         )
-        
-        if not frames:
-            print("錯誤: 未能抽取任何幀")
+        if metadata is None:
             return False
+    else:
+        # 網格排列需先知道幀數才能決定排列，之後邊去背邊逐頁合成，不必保留所有幀
+        num_frames = None
+        max_frames = args.max_frames
+        if args.pack == "grid":
+            num_frames = get_frame_count(input_path, args.fps, args.start, args.end, args.max_frames,
+                                         args.hwaccel, video_info['video_duration'])
+            if num_frames == 0:
+                print("錯誤: 未能抽取任何幀")
+                return False
+            max_frames = num_frames
         
-        print()
+        # 抽取幀 (直接串流至記憶體，邊解碼邊處理)
+        frames = extract_frames(
+            input_path,
+            target_width,
+            target_height,
+            fps=args.fps,
+            start_time=args.start,
+            end_time=args.end,
+            max_frames=max_frames,
+            hwaccel=args.hwaccel
+        )
         
         # 建立 Sprite Sheet
         metadata = create_spritesheet(
             frames,
             output_path,
-            frame_width=frame_width,
-            frame_height=frame_height,
+            (target_width, target_height),
+            num_frames=num_frames,
             columns=args.columns,
-            remove_bg=args.remove_bg
+            session=session,
+            image_format=args.format,
+            compress_level=args.compress_level,
+            pack=args.pack,
+            max_dim=args.max_sheet_dim
         )
-        
-        # 儲存 metadata
-        if args.json:
-            save_metadata(metadata, output_path)
+        if metadata is None:
+            return False
+    
+    # 儲存 metadata
+    if args.json:
+        save_metadata(metadata, output_path)
     
     return True
 
 
+def _init_worker(remove_bg, rembg_model, rembg_providers, rembg_threads):
+    """ProcessPoolExecutor 的 initializer：每個 worker 行程只載入一次去背模型
+
+    載入失敗時不可讓例外離開 initializer (會使整個 process pool 失效)，改由之後的每個影片回報失敗。
+    """
+    global _worker_session, _worker_init_log, _worker_init_failed
+    if remove_bg:
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            try:
+                _worker_session = create_rembg_session(rembg_model, rembg_providers, rembg_threads)
+            except SystemExit:
+                _worker_init_failed = True
+        _worker_init_log = log.getvalue()
+
+
+def _process_video_task(task):
+    """ProcessPoolExecutor 的 worker：處理單一影片，回傳 (是否成功, 輸出紀錄)"""
+    global _worker_init_log
+    video_path, output_path, args_dict = task
+    args = argparse.Namespace(**args_dict)
+    
+    if _worker_init_failed:
+        return False, _worker_init_log
+    
+    # 擷取子行程輸出，避免多個影片的進度訊息交錯
+    log = io.StringIO()
+    log.write(_worker_init_log)
+    _worker_init_log = ""
+    with contextlib.redirect_stdout(log):
+        try:
+            ok = process_single_video(video_path, output_path, args, session=_worker_session)
+        except SystemExit:
+            ok = False
+    
+    return ok, log.getvalue()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="將影片轉換成 Sprite Sheet 圖集",
@@ -340,6 +1074,9 @@ def main():
   %(prog)s video.mp4 -w 128 -H 128 -c 10
   %(prog)s video.mp4 --start 0 --end 5 --json
   %(prog)s video.mp4 --remove-bg -o transparent.png
+  %(prog)s video.mp4 --remove-bg --pack shelf --json
+  %(prog)s video.mp4 --format webp   # 輸出無損 WebP
+  %(prog)s ./videos/ -j 4            # 同時處理 4 個影片
         """
     )
     
@@ -354,7 +1091,22 @@ def main():
     parser.add_argument("--end", type=float, help="結束時間 (秒)")
     parser.add_argument("--max-frames", type=int, help="最大幀數限制")
     parser.add_argument("--json", action="store_true", help="輸出 JSON metadata")
+    parser.add_argument("--format", choices=["png", "webp"], default="png", help="輸出圖片格式 (預設: png)")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=1, metavar="0-9",
+                        help="壓縮等級，越大檔案越小但越慢 (預設: 1)")
     parser.add_argument("--remove-bg", action="store_true", help="移除背景 (需要安裝 rembg)")
+    parser.add_argument("--hwaccel", choices=["none", "auto", "cuda", "qsv", "videotoolbox"], default="auto",
+                        help="FFmpeg 硬體解碼方式，auto 在不可用時自動退回軟體解碼，明確指定的裝置不可用時直接報錯 (預設: auto)")
+    parser.add_argument("--max-sheet-dim", type=int, default=DEFAULT_MAX_SHEET_DIM,
+                        help=f"Sprite Sheet 最大邊長，超過時拆成多頁輸出，0 表示不限制 (預設: {DEFAULT_MAX_SHEET_DIM})")
+    parser.add_argument("--pack", choices=["grid", "shelf"], default="grid",
+                        help="排列方式：grid 為網格，shelf 會裁掉透明邊緣並依高度緊密排列 (需搭配 --remove-bg，預設: grid)")
+    parser.add_argument("--rembg-model", default=os.environ.get("REMBG_MODEL"),
+                        help="rembg 使用的模型，例如 u2net (預設: 環境變數 REMBG_MODEL 或 rembg 預設模型)")
+    parser.add_argument("--rembg-device", choices=["auto", *REMBG_PROVIDERS], default="auto",
+                        help="rembg 推論裝置 (預設: auto，由 rembg 自動選擇)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="同時處理的影片數 (預設: CPU 核心數；使用 --remove-bg 時為 1，每個行程都會各自載入一份去背模型)")
     
     args = parser.parse_args()
     
@@ -366,6 +1118,7 @@ def main():
     
     # 檢查 FFmpeg
     check_ffmpeg()
+    check_hwaccel(args.hwaccel)
     
     # 檢查 rembg
     if args.remove_bg and not REMBG_AVAILABLE:
@@ -375,6 +1128,30 @@ def main():
         print('  pip install "rembg[gpu]"    # GPU 版本 (需要 NVIDIA/CUDA)')
         sys.exit(1)
     
+    if args.pack == "shelf" and not args.remove_bg:
+        print("錯誤: --pack shelf 需要搭配 --remove-bg 使用")
+        sys.exit(1)
+    
+    if args.max_sheet_dim < 0:
+        print("錯誤: --max-sheet-dim 不可小於 0")
+        sys.exit(1)
+    
+    # WebP 單邊最多 16383 像素，超過時無法編碼
+    if args.format == "webp" and (args.max_sheet_dim == 0 or args.max_sheet_dim > WEBP_MAX_DIM):
+        print(f"WebP 尺寸上限為 {WEBP_MAX_DIM}，--max-sheet-dim 調整為 {WEBP_MAX_DIM}")
+        args.max_sheet_dim = WEBP_MAX_DIM
+    
+    if args.remove_bg and args.rembg_model and REMBG_MODELS is not None and args.rembg_model not in REMBG_MODELS:
+        print(f"錯誤: 找不到去背模型 - {args.rembg_model}")
+        print(f"可用的模型: {', '.join(REMBG_MODELS)}")
+        sys.exit(1)
+    
+    # 檢查 rembg 使用的推論裝置
+    rembg_providers = None
+    if args.remove_bg:
+        rembg_providers = check_rembg_provider(args.rembg_device)
+        print()
+    
     # 判斷輸入是檔案還是資料夾
     if input_path.is_file():
         # 單一檔案模式
@@ -389,17 +1166,17 @@ def main():
         print(f"找到 {len(video_files)} 個影片檔案")
         print()
     
-    # 處理每個影片
-    success_count = 0
-    fail_count = 0
+    # 輸出檔名的副檔名需與 --format 一致，避免將 WebP 內容寫進 .png 檔
+    if args.output:
+        output_suffix = Path(args.output).suffix
+        if output_suffix and output_suffix.lower() != f".{args.format}":
+            args.output = str(Path(args.output).with_suffix(f".{args.format}"))
+            print(f"警告: 輸出副檔名 {output_suffix} 與 --format {args.format} 不符，改為輸出 {args.output}")
+            print()
     
-    for i, video_path in enumerate(video_files, 1):
-        if len(video_files) > 1:
-            print(f"{'='*60}")
-            print(f"[{i}/{len(video_files)}] 處理: {video_path.name}")
-            print(f"{'='*60}")
-        
-        # 決定輸出檔名
+    # 決定每個影片的輸出檔名
+    tasks = []
+    for video_path in video_files:
         if args.output:
             if len(video_files) == 1:
                 output_path = args.output
@@ -409,25 +1186,76 @@ def main():
                 if output_dir.suffix == "":
                     # 視為資料夾
                     output_dir.mkdir(parents=True, exist_ok=True)
-                    output_path = str(output_dir / f"{video_path.stem}_spritesheet.png")
+                    output_path = str(output_dir / f"{video_path.stem}_spritesheet.{args.format}")
                 else:
                     # 視為前綴
                     output_path = f"{video_path.stem}_{args.output}"
         else:
             # 預設輸出檔名：與影片同名
-            output_path = str(video_path.parent / f"{video_path.stem}_spritesheet.png")
+            output_path = str(video_path.parent / f"{video_path.stem}_spritesheet.{args.format}")
         
-        # 處理影片
-        if process_single_video(video_path, output_path, args):
-            success_count += 1
+        # args 以 dict 傳遞，確保可被 pickle 到子行程
+        tasks.append((video_path, output_path, vars(args)))
+    
+    # 處理每個影片
+    success_count = 0
+    fail_count = 0
+    
+    # 去背時每個行程各載入一份模型，且 ONNX Runtime 本身已會使用所有核心，預設不平行處理
+    default_jobs = 1 if args.remove_bg else os.cpu_count() or 1
+    jobs = min(args.jobs or default_jobs, len(tasks))
+    if jobs > 1:
+        print(f"平行處理: {jobs} 個行程")
+        print()
+        # 將 CPU 核心平均分給每個行程的 ONNX Runtime，避免執行緒數量隨行程數倍增
+        rembg_threads = max(1, (os.cpu_count() or 1) // jobs)
+        # 使用 spawn 而非 fork：onnxruntime/numba (rembg 的依賴) 的執行緒池在 fork 後不安全，
+        # 會導致程式結束時卡住；spawn 也是 Windows/macOS 的預設行為
+        executor = ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(args.remove_bg, args.rembg_model, rembg_providers, rembg_threads)
+        )
+        results = executor.map(_process_video_task, tasks)
+    else:
+        executor = None
+        # 所有影片共用同一個去背模型，只載入一次
+        session = create_rembg_session(args.rembg_model, rembg_providers) if args.remove_bg else None
+        if session is not None:
             print()
-            print("✅ 轉換完成！")
-        else:
-            fail_count += 1
+        results = (
+            process_single_video(video_path, output_path, args, session=session)
+            for video_path, output_path, _ in tasks
+        )
+    
+    try:
+        for i, (video_path, _, _) in enumerate(tasks, 1):
+            if len(video_files) > 1:
+                print(f"{'='*60}")
+                print(f"[{i}/{len(video_files)}] 處理: {video_path.name}")
+                print(f"{'='*60}")
+            
+            # 處理影片 (平行模式下子行程的輸出會整段回傳後再顯示)
+            if executor is not None:
+                ok, log = next(results)
+                print(log, end="")
+            else:
+                ok = next(results)
+            
+            if ok:
+                success_count += 1
+                print()
+                print("✅ 轉換完成！")
+            else:
+                fail_count += 1
+                print()
+                print("❌ 轉換失敗！")
+            
             print()
-            print("❌ 轉換失敗！")
-        
-        print()
+    finally:
+        if executor is not None:
+            executor.shutdown()
     
     # 顯示總結
     if len(video_files) > 1: